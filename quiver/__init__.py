@@ -2,7 +2,7 @@ from .library import Library
 from .utils import (read_csv, set_path, get_path,
     get_lib_size, get_subject_size, get_item_size,
     write_metadata, read_metadata,
-    set_partition_size, get_partition_size,
+    set_partition_size, get_partition_size, set_auto_confirm,
     list_libraries, delete_libraries, delete_library,)
 
 __version__ = "0.0.86"
@@ -11,5 +11,5 @@ __author__ = "Some Guy"
 __all__ = ["Library", "read_csv", "get_path", "set_path",
            "get_lib_size", "get_subject_size", "get_item_size",
            "write_metadata", "read_metadata",
-           "set_partition_size", "get_partition_size",
+           "set_partition_size", "get_partition_size", "set_auto_confirm",
            "list_libraries", "delete_libraries", "delete_library"]
\ No newline at end of file
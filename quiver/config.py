@@ -3,4 +3,10 @@ from .utils import Path
 
 DEFAULT_PATH = os.environ.get("QUIVER_PATH", Path.home() / "quiver")
 DEFAULT_PARTITION_SIZE = 500e+6  # ~500MB
-PARTITION_SIZE = 500e+6  # ~500MB
\ No newline at end of file
+# defaults for every parquet write, row_group_size is in rows
+PARQUET_WRITE_OPTIONS = {"compression": "zstd", "compression_level": 3, "statistics": True,
+                         "row_group_size": 1024 * 1024}
+PARQUET_PAGE_INDEX = True  # eager writes go through pyarrow to store column and offset indexes
+PARTITION_SIZE = 500e+6  # ~500MB
+# answer yes to every confirmation prompt, QUIVER_NONINTERACTIVE=1 turns it on for scripts and CI
+AUTO_CONFIRM = os.environ.get("QUIVER_NONINTERACTIVE", "").lower() not in ("", "0", "false", "no")
\ No newline at end of file
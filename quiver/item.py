@@ -1,13 +1,36 @@
+import os
+import threading
+from collections import OrderedDict
 import polars as pl
 import duckdb
 
 from . import utils
 
+# (item path, item dir mtime_ns, snapshot, parallel, low_memory) -> (parquet files, base lazy frame),
+# least recently used first
+_SCAN_CACHE = OrderedDict()
+_SCAN_CACHE_SIZE = 256
+_SCAN_LOCK = threading.Lock()
+
+
+def clear_scan_cache():
+    """ drops the cached item scans """
+    with _SCAN_LOCK:
+        _SCAN_CACHE.clear()
+
+
 class Item:
+    __slots__ = ("item", "library", "subject", "snapshot", "filters", "columns", "sort_on",
+                 "schema", "zero_copy", "streaming", "low_memory", "threads", "memory_limit",
+                 "_sort_columns", "_collect", "_path", "_files", "_data", "_metadata", "_db", "_con",
+                 "_view_schema", "table")
+
     def __repr__(self):
         return f"Quiver.item {self.library}/{self.subject}/{self.item}"
 
-    def __init__(self, item, library, subject, snapshot=None, filters=None, columns=None, sort_on=None):
+    def __init__(self, item, library, subject, snapshot=None, filters=None, columns=None, sort_on=None,
+                 schema=None, zero_copy=True, streaming=True, db=None,
+                 low_memory=False, threads=None, memory_limit=None):
         self.item = item
         self.library = library
         self.subject = subject
@@ -15,33 +38,188 @@ class Item:
         self.filters = filters
         self.columns = columns
         self.sort_on = sort_on
+        if isinstance(sort_on, str):
+            self._sort_columns = [sort_on]
+        else:
+            self._sort_columns = list(sort_on) if sort_on else None
+        self.schema = schema
+        self.zero_copy = zero_copy
+        self.streaming = streaming
+        self._collect = self._collect_streaming if streaming else self._collect_eager
+        self.low_memory = low_memory
+        self.threads = threads
+        self.memory_limit = memory_limit
 
-        self._path = utils.make_path(self.library, self.subject, self.item)
+        if snapshot is None:
+            self._path = utils.make_path(self.library, self.subject, self.item)
+        else:
+            # read the copy taken by subject.create_snapshot
+            self._path = utils.make_path(self.library, self.subject, "_snapshots", snapshot, self.item)
+            if not self._path.exists():
+                raise ValueError(f"Item {self.item} is not in snapshot {snapshot} of subject {self.subject}")
 
         if not self._path.exists():
             raise ValueError(
                 f"Item {self.item} does not exist"
                 f"Create it by using subject.write({item}, data_obj, ...) in library {self.library}"
             )
-        self._files = [f for f in self._path.rglob("*/*.parquet") if f.is_file()]
-        self._parquet_path = utils.Path(self._path,"*/*.parquet" )
-        if snapshot:
-            snap_path = utils.make_path(self.library, self.subject, '_snapshots', self.item)
+        # one duckdb schema per subject (and snapshot), the view is "<subject>"."<item>"
+        self._view_schema = self.subject if snapshot is None else f"{self.subject}@{snapshot}"
+        self.table = f"{utils.sql_identifier(self._view_schema)}.{utils.sql_identifier(self.item)}"
+
+        # data, metadata and the duckdb view are built on first access
+        self._files = None
+        self._data = None
+        self._metadata = None
+        self._db = db
+        self._con = None
 
-        self.data = pl.scan_parquet(self._parquet_path).drop('partition')
+    @property
+    def data(self):
+        if self._data is None:
+            self._files, data = self._scan()
+            self._data = self._load_data(data)
+        return self._data
+
+    @property
+    def metadata(self):
+        if self._metadata is None:
+            self._metadata = utils.read_metadata(self._path)
+        return self._metadata
+
+    def _connection(self):
+        """
+        registers the dataset once so queries reuse the connection and parquet metadata,
+        on a shared (library) connection items can be joined against each other
+        :return:
+        """
+        if self._con is None:
+            self._files, _ = self._scan()
+            settings = {}
+            if self.threads is not None:
+                settings["threads"] = int(self.threads)
+            if self.memory_limit is not None:
+                settings["memory_limit"] = str(self.memory_limit)
+            if settings or self._db is None:
+                # limits get their own connection, a SET on the library connection would apply
+                # to every item sharing it, duckdb validates the values
+                con = duckdb.connect(config=settings)
+            else:
+                con = self._db
+            con.execute("SET parquet_metadata_cache = true")
+            con.execute(f"CREATE SCHEMA IF NOT EXISTS {utils.sql_identifier(self._view_schema)}")
+            con.execute(
+                f"CREATE OR REPLACE VIEW {self.table} AS SELECT * EXCLUDE (partition) "
+                f"FROM read_parquet({utils.sql_file_list(self._files)}, hive_partitioning=1)"
+            )
+            self._con = con
+        return self._con
+
+    def _scan(self):
+        """
+        returns the parquet files and base lazy frame for the item,
+        cached until the item directory changes
+        :return:
+        """
+        path = str(self._path)
+        # prefiltered evaluates the predicate per row group before reading the other columns
+        parallel = "prefiltered" if self.filters is not None else "auto"
+        key = (path, os.stat(self._path).st_mtime_ns, self.snapshot, parallel, self.low_memory)
+        with _SCAN_LOCK:
+            cached = _SCAN_CACHE.get(key)
+            if cached is not None:
+                _SCAN_CACHE.move_to_end(key)
+                return cached
+        files = utils.list_parquet_files(self._path)
+        data = pl.scan_parquet(files, hive_partitioning=True, use_statistics=True,
+                               parallel=parallel, low_memory=self.low_memory).drop('partition')
+        cached = (files, data)
+        with _SCAN_LOCK:
+            for k in [k for k in _SCAN_CACHE if k[0] == path and k[1] != key[1]]:
+                del _SCAN_CACHE[k]
+            _SCAN_CACHE[key] = cached
+            if len(_SCAN_CACHE) > _SCAN_CACHE_SIZE:
+                _SCAN_CACHE.popitem(last=False)
+        return cached
+
+    def _load_data(self, data):
+        """
+        applies the item's filters, column selection and sort to the base scan
+        filter before select and sort so predicates reach the scan first
+        and discarded rows are never sorted
+        :param data: base lazy frame
+        :return:
+        """
+        if self.schema is not None:
+            data = self._validate_schema(data)
+        if self.filters is not None:
+            data = data.filter(self.filters)
+        if self.columns is not None:
+            data = data.select(self.columns)
+        if self._sort_columns is not None:
+            data = data.sort(self._sort_columns)
+        return data
+
+    def _validate_schema(self, data):
+        """
+        casts the lazy frame to the subject schema, adding any missing columns as nulls
+        :param data: lazy frame
+        :return:
+        """
+        existing = set(data.collect_schema().names())
+        present = [pl.col(c).cast(dt).alias(c) for c, dt in self.schema.items() if c in existing]
+        missing = [pl.lit(None).cast(dt).alias(c) for c, dt in self.schema.items() if c not in existing]
+        return data.with_columns(present + missing)
+
+    @staticmethod
+    def _collect_streaming(data):
+        # the streaming engine processes the parquet in batches instead of all at once
+        return data.collect(engine="streaming")
+
+    @staticmethod
+    def _collect_eager(data):
+        return data.collect()
 
     def to_pandas(self):
-        return self.data.collect().to_pandas()
+        # arrow backed columns share the polars buffers instead of copying into numpy
+        return self._collect(self.data).to_pandas(use_pyarrow_extension_array=self.zero_copy)
 
     def to_polars(self):
-        return self.data.collect()
+        return self._collect(self.data)
 
     def tail(self, n=5):
-        return self.data.tail(n).collect().to_pandas()
+        return self._collect(self.data.tail(n)).to_pandas(use_pyarrow_extension_array=self.zero_copy)
 
     def head(self, n=5):
-        return self.data.head(n).collect().to_pandas()
-
+        # the slice is pushed down to the scan, only the first row groups are read
+        return self._collect(self.data.head(n)).to_pandas(use_pyarrow_extension_array=self.zero_copy)
 
+    def query_data(self, sql=None, params=None):
+        """
+        runs a sql query against the item, the item is available as the view named by item.table
+        ("<subject>"."<item>"), with no sql the whole item is returned
+        parameters are bound as a prepared statement, reference them as $name in the sql
+        :param sql: e.g. 'SELECT * FROM "etf_minute_data"."SPY" WHERE tstamp > $start'
+        :param params: e.g. {"start": "2024-01-01"}
+        :return: polars dataframe
+        """
+        if sql is None:
+            sql = f"SELECT * FROM {self.table}"
+        return self._connection().execute(sql, params or {}).pl()
 
+    def explain_query(self, sql):
+        """
+        returns the duckdb physical plan for a query against the item view
+        :param sql:
+        :return:
+        """
+        return "\n".join(row[1] for row in self._connection().execute(f"EXPLAIN {sql}").fetchall())
 
+    def close(self):
+        if self._con is None:
+            return True
+        # a shared library connection is closed by the library, its views stay for the other items
+        if self._con is not self._db:
+            self._con.close()
+        self._con = None
+        return True
@@ -1,25 +1,32 @@
 # This file contains the Library class, which is the main interface for the user to interact with the library.
 
 from .subject import Subject
+from .item import clear_scan_cache
 import os
-import shutil
 from . import utils
 import duckdb
+import polars as pl
 
 class Library:
     def __repr__(self):
         return f"Quiver.library {self.library}"
 
-    def __init__(self, library):
+    def __init__(self, library, confirm=None):
+        # confirm(message) -> bool, answers the create/delete prompts
+        self._confirm = confirm if confirm is not None else utils.confirm_prompt
         library_path = utils.get_path()
         if not utils.path_exists(library_path):
             os.mkdir(library_path)
         self.library = utils.make_path(library_path, library)
         if not utils.path_exists(self.library):
             os.mkdir(self.library)
+        utils.sweep_deleting(library_path)
+        utils.sweep_deleting(self.library)
         self.metadata = utils.read_metadata(self.library)
         self.subjects = self.list_subjects()
         self.db = duckdb.connect()
+        # subject name -> (subject dir mtime_ns, Subject), saves rebuilding a subject on every lookup
+        self._subject_cache = {}
 
     def save_library_metadata(self,metadata):
         """
@@ -28,11 +35,10 @@ class Library:
         :param metadata:
         :return:
         """
-        if utils.path_exists(utils.make_path(self.library, 'quiver_metadata.json')):
-            existing_metadata = utils.read_metadata(utils.make_path(self.library))
-            for e in existing_metadata:
-                if e not in metadata:
-                    metadata[e] = existing_metadata[e]
+        existing_metadata = utils.read_metadata(utils.make_path(self.library))
+        for e in existing_metadata:
+            if e not in metadata:
+                metadata[e] = existing_metadata[e]
         utils.write_metadata(self.library, metadata)
         self.metadata = metadata
         return True
@@ -53,25 +59,23 @@ class Library:
         # update subjects
         self.subjects = self.list_subjects()
         if metadata is not None:
-            if utils.path_exists(utils.make_path(self.library, subject, 'quiver_metadata.json')):
-                existing_metadata = utils.read_metadata(utils.make_path(self.library, subject))
-                for e in existing_metadata:
-                    if e not in metadata:
-                        metadata[e] = existing_metadata[e]
+            existing_metadata = utils.read_metadata(utils.make_path(self.library, subject))
+            for e in existing_metadata:
+                if e not in metadata:
+                    metadata[e] = existing_metadata[e]
             utils.write_metadata(utils.make_path(self.library, subject), metadata)
         # return the subject
-        return Subject(subject, self.library)
+        return self._get_subject(subject)
 
     def delete_subject(self, subject, confirm=True):
         # delete subject (subdir)
         if subject not in self.subjects:
             raise ValueError(f"Subject {subject} does not exist")
-        if confirm:
-            confirm = input(f"Delete subject {subject}? (y/n)")
-            if confirm.lower() != "y":
-                print("Deletion aborted")
-                return False
-        shutil.rmtree(utils.make_path(self.library, subject))
+        if not utils.confirmed(confirm, f"Delete subject {subject}? (y/n)", self._confirm):
+            print("Deletion aborted")
+            return False
+        utils.remove_tree(utils.make_path(self.library, subject))
+        self._subject_cache.pop(subject, None)
         # update subjects
         self.subjects = self.list_subjects()
         return True
@@ -82,31 +86,56 @@ class Library:
 
     def subject(self, subject, metadata=None, overwrite=False):
         if subject in self.subjects and not overwrite:
-            return Subject(subject, self.library)
+            return self._get_subject(subject)
 
         # create it
         if subject not in self.subjects:
-            confirm = input(f"Subject {subject} does not exist. Create it? (y/n)")
-            if confirm.lower() != "y":
+            if not self._confirm(f"Subject {subject} does not exist. Create it? (y/n)"):
                 print("Aborted")
                 return None
             else:
                 self._create_subject(subject, metadata=metadata, overwrite=overwrite)
 
-
-
-        return Subject(subject, self.library)
+        return self._get_subject(subject)
+
+    def _get_subject(self, subject):
+        # items added or removed elsewhere (another Library, another process) change the
+        # directory mtime, the cached subject's items and inventory are stale then
+        try:
+            mtime = os.stat(utils.make_path(self.library, subject)).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        cached = self._subject_cache.get(subject)
+        if cached is None or cached[0] != mtime:
+            cached = self._subject_cache[subject] = (
+                mtime, Subject(subject, self.library, db=self.db, confirm=self._confirm))
+        return cached[1]
 
     def item(self, subject, item):
-        # bypasses subject
+        # bypasses subject, the item view is registered on the library connection
         return self.subject(subject).item(item)
 
+    def collect_items(self, items_specs):
+        """
+        materializes several items in one optimized polars run,
+        repeated scans across the items are shared
+        :param items_specs: list of (subject, item) tuples
+        :return: list of polars dataframes in the same order
+        """
+        lazyframes = [self.item(subject, item).data for subject, item in items_specs]
+        return pl.collect_all(lazyframes, engine="streaming")
+
     def stop_db(self):
         self.db.close()
+        # cached subjects hold the closed connection
+        self._subject_cache.clear()
+        clear_scan_cache()
         return True
 
     def start_db(self):
         self.db = duckdb.connect()
+        # cached subjects hold the previous connection
+        self._subject_cache.clear()
         return self.db
 
 
@@ -1,10 +1,17 @@
 # subject is where all you items are stored
 import os
 import time
+import bisect
+import uuid
 import shutil
+from concurrent.futures import ThreadPoolExecutor
+from functools import cached_property
 import polars as pl
 import duckdb
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyarrow.dataset as ds
 from . import utils
 from .item import Item
 from . import config
@@ -13,99 +20,269 @@ class Subject:
     def __repr__(self):
         return f"Quiver.subject {self.library}/{self.subject}"
 
-    def __init__(self, subject, library):
+    def __init__(self, subject, library, db=None, confirm=None):
         self.subject = subject
         self.library = library
-        self.items = self.list_items()
-        self.snapshots = self.list_snapshots()
-        self.inventory = self._create_inventory()
+        self._confirm = confirm if confirm is not None else utils.confirm_prompt
         self.schema = None
+        # share the library's duckdb connection
+        if db is not None:
+            self.db = db
 
         self.subject_path = utils.make_path(self.library, self.subject)
-        self.metadata = utils.read_metadata(self.subject_path)
+
+    @cached_property
+    def db(self):
+        # a standalone subject connects on first use
+        return duckdb.connect()
+
+    @cached_property
+    def metadata(self):
+        return utils.read_metadata(self.subject_path)
+
+    @cached_property
+    def items(self):
+        return self.list_items()
+
+    @cached_property
+    def snapshots(self):
+        return self.list_snapshots()
+
+    @cached_property
+    def inventory(self):
+        return self._create_inventory()
+
+    @cached_property
+    def _dataset(self):
+        # file discovery and footer reads happen once, not on every full_subject call
+        files = [f for item in self.items for f in utils.list_parquet_files(self._item_path(item))]
+        schema = pl.DataFrame(schema=self.schema).to_arrow().schema
+        return ds.dataset(files, schema=schema, format="parquet",
+                          partitioning="hive", partition_base_dir=str(self.subject_path))
+
+    def prefetch(self):
+        """
+        lists the items and snapshots and reads the subject metadata concurrently,
+        then builds the inventory, for callers that want all of it up front
+        :return:
+        """
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            f_items = executor.submit(self.list_items)
+            f_snapshots = executor.submit(self.list_snapshots)
+            f_metadata = executor.submit(utils.read_metadata, self.subject_path)
+            self.__dict__["items"] = f_items.result()
+            self.__dict__["snapshots"] = f_snapshots.result()
+            self.metadata = f_metadata.result()
+        self.__dict__["inventory"] = self._create_inventory()
+        return self
+
+    def _invalidate(self, *names):
+        # drop cached properties so they are rebuilt on next access
+        for name in names:
+            self.__dict__.pop(name, None)
+
+    def _add_item(self, item):
+        # keep an already listed items list sorted without re-listing the subject
+        items = self.__dict__.get("items")
+        if items is not None:
+            i = bisect.bisect_left(items, item)
+            if i == len(items) or items[i] != item:
+                items.insert(i, item)
 
     def _item_path(self, item, as_string=False):
-        p = utils.make_path(self.library, self.subject, item)
+        # join onto the already parsed subject path instead of building from the parts
+        p = self.subject_path / item
         if as_string:
             return str(p)
         return p
 
+    @staticmethod
+    def _part_file_name():
+        # time ordered names, files in a partition are read in the order they were written
+        return f"part_{time.time_ns():020d}_{uuid.uuid4().hex[:8]}.parquet"
+
+    def _clear_partitions(self, i_path):
+        """
+        removes an item's data before it is overwritten, partition dirs left in place
+        would be read alongside the new files
+        :param i_path:
+        :return:
+        """
+        a_path = utils.make_path(i_path, "appended_data.parquet")
+        if utils.path_exists(a_path):
+            os.remove(a_path)
+        for p in utils.subdirs(i_path):
+            if p.startswith("partition="):
+                utils.remove_tree(utils.make_path(i_path, p))
+
     def list_items(self,**kwargs):
+        """
+        items of the subject, with kwargs only those whose metadata has the given values,
+        a value of None matches items where the key is None or missing
+        :param kwargs: metadata key=value pairs
+        :return:
+        """
         dirs = utils.subdirs(utils.make_path(self.library, self.subject))
         if not kwargs:
-            return sorted(set(dirs))
-
-        matched = []
-        for d in dirs:
-            meta = utils.read_metadata(utils.make_path(
-                self.library, self.subject, d))
-            del meta["_updated"]
-
-            m = 0
-            keys = list(meta.keys())
-            for k, v in kwargs.items():
-                if k in keys and meta[k] == v:
-                    m += 1
-
-            if m == len(kwargs):
-                matched.append(d)
-
-        return sorted(set(matched))
+            return dirs
+
+        if not dirs:
+            return []
+
+        # filter the cached inventory, no metadata files are read per call,
+        # rebuilt when items were added or removed outside this subject
+        if dirs != self.items:
+            self.__dict__["items"] = dirs
+            self._invalidate("inventory", "_dataset")
+        inventory = self.inventory
+        if any(k not in inventory.columns for k in kwargs):
+            # none of the items has one of the keys
+            return []
+        mask = None
+        for k, v in kwargs.items():
+            match = self._inventory_match(inventory.get_column(k), v)
+            mask = match if mask is None else mask & match
+        return sorted(inventory.filter(mask).get_column("item").to_list())
+
+    @staticmethod
+    def _inventory_match(column, value):
+        """
+        boolean series of the inventory rows whose metadata value equals value
+        :param column: inventory column
+        :param value:
+        :return:
+        """
+        if value is None and column.dtype != pl.Object:
+            return column.is_null()
+        if column.dtype != pl.Object:
+            try:
+                return (column == value).fill_null(False)
+            except (pl.exceptions.PolarsError, TypeError, ValueError):
+                pass
+        # mixed value types, compare as python objects
+        if value is None:
+            return pl.Series(column.name, [v is None for v in column.to_list()], dtype=pl.Boolean)
+        return pl.Series(column.name, [v == value for v in column.to_list()], dtype=pl.Boolean)
 
     def save_subject_metadata(self,metadata):
         """
-        Save metadata to the library, should have
+        Save metadata to the subject, should have
         metadata['description'] = "some description of the data in the subject'
         metadata['schema'] = "schema of the data in the subject"
         metadata['source'] = "source of the data in the subject"
         :param metadata:
         :return:
         """
-        if utils.path_exists(utils.make_path(self.library, self.subject, 'quiver_metadata.json')):
-            existing_metadata = utils.read_metadata(utils.make_path(self.library,self.subject))
-            for e in existing_metadata:
-                if e not in metadata:
-                    metadata[e] = existing_metadata[e]
-        utils.write_metadata(self.library, metadata)
+        existing_metadata = utils.read_metadata(self.subject_path)
+        for e in existing_metadata:
+            if e not in metadata:
+                metadata[e] = existing_metadata[e]
+        utils.write_metadata(self.subject_path, metadata)
         self.metadata = metadata
         return True
 
     def _create_inventory(self):
         """
-        creates a pandas dataframe of all the metadata for the items in the subject
+        creates a polars dataframe of all the metadata for the items in the subject
         can be used for advanced sorting and filtering
         :return:
         """
-        inventory = []
-        for item in self.items:
-            metadata = utils.read_metadata(self._item_path(item))
-
-            if item not in metadata.values():
-                metadata['item'] = item
-            inventory.append(metadata)
-        return pd.DataFrame.from_records(inventory)
-
-    def item(self, item, snapshot=None, filters=None, columns=None, sort_on=None):
-        return Item(item, self.library, self.subject, snapshot=None, filters=None, columns=None, sort_on=None)
-
-    def index(self, item, index_col='tstamp', last=False):
+        items = self.items
+        all_metadata = utils.read_metadata_batch([self._item_path(item) for item in items])
+        # build column-wise, keys missing from an item's metadata are null
+        keys = dict.fromkeys(k for metadata in all_metadata for k in metadata)
+        keys.pop('item', None)
+        columns = [self._inventory_column(k, [metadata.get(k) for metadata in all_metadata]) for k in keys]
+        columns.append(pl.Series('item', list(items)))
+        return pl.DataFrame(columns)
+
+    @staticmethod
+    def _inventory_column(name, values):
+        """
+        a typed column for one metadata key, an object column when the items disagree on the type
+        so values are never coerced (e.g. 1 and "1")
+        :param name:
+        :param values:
+        :return:
+        """
+        types = {float if type(v) is int else type(v) for v in values if v is not None}
+        if len(types) <= 1:
+            try:
+                return pl.Series(name, values)
+            except (pl.exceptions.PolarsError, TypeError, ValueError, OverflowError):
+                pass
+        return pl.Series(name, values, dtype=pl.Object)
+
+    def item(self, item, snapshot=None, filters=None, columns=None, sort_on=None, db=None):
+        # only a connection that is already open, reading an item should not open one,
+        # without one the item connects when it is first queried
+        if db is None:
+            db = self.__dict__.get("db")
+        return Item(item, self.library, self.subject, snapshot=snapshot, filters=filters, columns=columns, sort_on=sort_on,
+                    schema=self.schema, db=db)
+
+    def _index_max(self, item, col):
+        """
+        max of a column from the parquet footer statistics, no column data is read
+        :param item:
+        :param col:
+        :return: the max, as the python value polars gives for the column,
+            or None if a row group was written without statistics
+        """
+        maximum = None
+        arrow_type = None
+        for f in utils.list_parquet_files(self._item_path(item)):
+            md = pq.read_metadata(f)
+            names = md.schema.names
+            if col not in names:
+                continue
+            j = names.index(col)
+            arrow_type = md.schema.to_arrow_schema().field(col).type
+            for rg in range(md.num_row_groups):
+                stats = md.row_group(rg).column(j).statistics
+                if stats is None or not stats.has_min_max:
+                    return None
+                if maximum is None or stats.max > maximum:
+                    maximum = stats.max
+        if maximum is None:
+            return None
+        # pyarrow gives pandas Timestamps for ns columns, go through polars so the type
+        # matches the scan fallback (datetime.datetime)
+        return pl.from_arrow(pa.array([maximum], type=arrow_type)).item()
+
+    def index(self, item, index_col='tstamp', last=False, where=None):
+        """
+        the index column of an item
+        :param item:
+        :param index_col:
+        :param last: only the last (max) index value
+        :param where: polars expression, row groups whose statistics cannot match are skipped
+        :return:
+        """
         i_path = self._item_path(item)
-        data = pl.scan_parquet(utils.make_path(i_path, "*.parquet")).select(index_col)
+        data = pl.scan_parquet(utils.list_parquet_files(i_path), hive_partitioning=True,
+                               use_statistics=True)
+        if where is not None:
+            data = data.filter(where)
+        data = data.select(index_col)
+        if last and where is None:
+            maximum = self._index_max(item, index_col)
+            if maximum is None:
+                # written without statistics, fall back to scanning the column
+                return data.max().collect().item()
+            return maximum
         if last:
             return data.max().collect().item()
         return data.collect()
 
 
     def delete_item(self, item, confirm=True):
-        if confirm:
-            confirm = input(
-                f"Are you sure you want to delete {item}? (y/n): ")
-            if confirm.lower() != "y":
-                print("Deletion aborted")
-                return False
+        if not utils.confirmed(confirm, f"Are you sure you want to delete {item}? (y/n): ", self._confirm):
+            print("Deletion aborted")
+            return False
         i_path = self._item_path(item)
-        shutil.rmtree(i_path)
-        self.items = self.list_items()
+        utils.remove_tree(i_path)
+        self._invalidate("items", "inventory", "_dataset")
         return True
 
     def full_subject(self):
@@ -116,9 +293,7 @@ class Subject:
         if self.schema is None:
             raise ValueError("No schema found. Use `set_schema(item)` to set the golden schema")
 
-        sub_path = utils.make_path(self.library, self.subject)
-        sub_gen = utils.make_path(sub_path, "*", "*.parquet")
-        return pl.scan_parquet(sub_gen, allow_missing_columns=True, schema=self.schema)
+        return pl.scan_pyarrow_dataset(self._dataset)
 
     def set_schema(self, item):
         """
@@ -126,11 +301,14 @@ class Subject:
         :param item:
         :return:
         """
-        i_path = self._item_path(item)
-        i_file = list(i_path.glob("*.parquet"))[0]
-        schema = pl.read_parquet_schema(i_file)
+        files = utils.list_parquet_files(self._item_path(item))
+        if not files:
+            raise ValueError(f"Item {item} has no parquet files to take a schema from")
+        # only the footer is read, the empty table carries the schema over to polars
+        schema = dict(pl.from_arrow(pq.read_schema(files[0]).empty_table()).schema)
         schema.pop('__null_dask_index__', None)
         self.schema = schema
+        self._invalidate("_dataset")
 
     def get_pivot(self, index, column, value):
         """
@@ -138,13 +316,15 @@ class Subject:
         :param index:
         :param column:
         :param value:
-        :return:
+        :return: polars dataframe
         """
         df = self.full_subject()
-        query_str = f"SELECT {index}, {column}, {value} FROM df;"
-        con = duckdb.connect()
-        result = con.execute(query_str).df().pivot(index=index, columns=column, values=value)
-        return result
+        for name in (index, column, value):
+            if name not in self.schema:
+                raise ValueError(f"Column {name} is not in the subject schema")
+        # only the three columns are read from the scan, the pivot stays in polars
+        return (df.select([index, column, value]).collect()
+                .pivot(on=column, index=index, values=value, aggregate_function="first"))
 
     def write(self, item, data_obj, metadata=None, sort_on=None,
               overwrite=False, partition_size=None, include_index=False,
@@ -167,10 +347,7 @@ class Subject:
                         Otherwise, use `<subject>.append()`""")
 
         # convert pandas to polars if needed
-        if isinstance(data_obj, pd.DataFrame):
-            df = pl.from_pandas(data_obj, include_index=include_index)
-        else:
-            df = data_obj
+        df = utils.to_polars(data_obj, include_index=include_index)
 
         # SORTING
         # sort data for optimal read performance
@@ -180,34 +357,39 @@ class Subject:
         # PARTITIONING
         if partition_size is None:
             partition_size = config.DEFAULT_PARTITION_SIZE
-        item_size = utils.get_item_size(self.library, self.subject, item)
-        n_partitions = int(1 + item_size // partition_size)
-        rows_per_partition = df.height // n_partitions
-        df = df.with_columns((pl.arange(0, df.height) // rows_per_partition).alias("partition"))
-
-        # Ensure the last partition includes any remaining rows
-        df = df.with_columns(pl.when(pl.col("partition") >= n_partitions).then((n_partitions-1)).otherwise(pl.col("partition")).alias("partition"))
+        if utils.path_exists(i_path):
+            item_size = utils.recorded_data_size(i_path)
+        else:
+            # nothing on disk yet, size the partitions from the data itself
+            item_size = df.estimated_size()
+        # one file with a row group per partition_size bytes, row group statistics
+        # give the same pruning as separate partition files without the extra files,
+        # never larger than the configured row group size so small items still get several groups
+        n_groups = int(1 + item_size // partition_size)
+        rows_per_group = max(1, -(-df.height // n_groups))
+        max_rows = config.PARQUET_WRITE_OPTIONS.get("row_group_size")
+        if max_rows:
+            rows_per_group = min(rows_per_group, max_rows)
 
-        # Write the DataFrame to Parquet files, partitioned by the 'partition' column
         if overwrite:
-            a_path = utils.make_path(i_path, "appended_data.parquet")
-            if utils.path_exists(a_path):
-                os.remove(a_path)
+            self._clear_partitions(i_path)
 
-        df.write_parquet(i_path, partition_by="partition", **kwargs)
+        # Write the DataFrame to a single Parquet file in the first hive partition
+        p_path = utils.make_path(i_path, "partition=0")
+        p_path.mkdir(parents=True, exist_ok=True)
+        kwargs.setdefault("row_group_size", rows_per_group)
+        df.write_parquet(utils.make_path(p_path, f"{item}.parquet"), **utils.parquet_write_options(kwargs))
         # METADATA
         if metadata is None:
-            if utils.path_exists(utils.make_path(i_path, "quiver_metadata.json")):
-                metadata = utils.read_metadata(utils.make_path(i_path))
-            else:
-                metadata = {}
+            metadata = utils.read_metadata(i_path)
+        # bookkeeping for append, saves globbing the partitions and stat-ing the appended file
+        metadata["_n_partitions"] = 1
+        metadata["_has_appended"] = False
+        metadata["_size_bytes"] = utils.parquet_size(i_path)
+        metadata["_append_bytes"] = 0
         utils.write_metadata(i_path, metadata)
-
-        if isinstance(self.items, list):
-            self.items.append(item)
-            self.items = sorted(set(self.items))
-        elif isinstance(self.items, set):
-            self.items.add(item)
+        self._add_item(item)
+        self._invalidate("inventory", "_dataset")
 
     def lazy_write(self, item, data_obj, metadata=None, sort_on=None, partition_size=None, overwrite=False, **kwargs):
         i_path = self._item_path(item)
@@ -224,39 +406,45 @@ class Subject:
         if sort_on is not None:
             df = df.sort(sort_on)
 
-        if overwrite:
-            a_path = utils.make_path(i_path, "appended_data.parquet")
-            if utils.path_exists(a_path):
-                os.remove(a_path)
         if partition_size is None:
             partition_size = config.DEFAULT_PARTITION_SIZE
 
-        item_size = utils.get_item_size(self.library, self.subject, item)
+        item_size = 0
+        if utils.path_exists(i_path):
+            item_size = utils.recorded_data_size(i_path)
         n_partitions = int(1 + item_size // partition_size)
-        df_height = df.select(pl.len()).collect().item()
-        rows_per_partition = df_height // n_partitions
-        df = df.with_columns((pl.arange(0, df_height) // rows_per_partition).alias("partition"))
-        df = df.with_columns(pl.when(pl.col("partition") >= n_partitions).then((n_partitions-1)).otherwise(pl.col("partition")).alias("partition"))
-        for partition, group in df.group_by("partition"):
-            p_path = utils.make_path(self.library, self.subject, item, f"partition={partition}")
-            if not utils.path_exists(i_path):
-                p_path.mkdir(parents=True)
-            # group = group.drop("partition")
-            p_i_path = utils.make_path(p_path, f"{item}.parquet")
-            df.sink_parquet(p_i_path, **kwargs)
+        df = df.with_columns(utils.partition_expr(n_partitions))
+
+        if overwrite:
+            self._clear_partitions(i_path)
+        # stream each partition to its own hive directory in a single pass
+        # the partition is in the directory name, keep the column out of the files
+        if hasattr(pl, "PartitionByKey"):
+            df.sink_parquet(pl.PartitionByKey(i_path, by=["partition"], include_key=False), mkdir=True,
+                            **utils.parquet_write_options(kwargs, eager=False))
+        else:
+            for partition in range(n_partitions):
+                p_path = utils.make_path(i_path, f"partition={partition}")
+                p_path.mkdir(parents=True, exist_ok=True)
+                p_i_path = utils.make_path(p_path, f"{item}.parquet")
+                df.filter(pl.col("partition") == partition).drop("partition").sink_parquet(
+                    p_i_path, **utils.parquet_write_options(kwargs, eager=False))
         if metadata is None:
-            if utils.path_exists(utils.make_path(i_path, "quiver_metadata.json")):
-                metadata = utils.read_metadata(utils.make_path(i_path))
-            else:
-                metadata = {}
+            metadata = utils.read_metadata(i_path)
+        # bookkeeping for append, saves globbing the partitions and stat-ing the appended file
+        metadata["_n_partitions"] = n_partitions
+        metadata["_has_appended"] = False
+        metadata["_size_bytes"] = utils.parquet_size(i_path)
+        metadata["_append_bytes"] = 0
         utils.write_metadata(i_path, metadata)
+        self._add_item(item)
+        self._invalidate("inventory", "_dataset")
+
     def append(self, item, data_obj, sort_on=None, include_index=False, **kwargs):
         """
         appends data to an item in a subject
-        first checks if there is a partition on called appended_data.parquet
-        if no such file exists then will write to new data to that partition
-        if the file exists it will read in the partition, concat the existing appended data with the new data
-        and then will overwrite the partition  appended_data.parquet
+        the new data is written as its own file in the partition after the written partitions,
+        existing files are never read or rewritten, use compact() to merge the appended files
         :param item:
         :param data_obj:
         :param sort_on:
@@ -264,12 +452,15 @@ class Subject:
         :return:
         """
         i_path = self._item_path(item)
-        i_files = list(i_path.glob("partition*/*.parquet"))
-        i_part = len(i_files)
-        a_path = utils.make_path(i_path, "appended_data.parquet")
-        data_obj =data_obj.with_columns(pl.lit(i_part).alias('partition'))
+        i_meta = utils.read_metadata(i_path)
+        i_part = i_meta.get("_n_partitions")
+        if i_part is None:
+            # written before the partition count was kept in the metadata
+            with os.scandir(i_path) as it:
+                i_part = sum(1 for e in it
+                             if e.is_dir(follow_symlinks=False) and e.name.startswith("partition="))
         if isinstance(data_obj, pd.DataFrame):
-            data_obj = pl.from_pandas(data_obj, include_index=include_index)
+            data_obj = utils.to_polars(data_obj, include_index=include_index)
         elif isinstance(data_obj, pl.LazyFrame):
             data_obj = data_obj.collect()
         elif isinstance(data_obj, pl.DataFrame):
@@ -277,19 +468,68 @@ class Subject:
         else:
             raise ValueError("Data object must be a pandas or polars DataFrame")
 
-        if utils.path_exists(a_path):
-            old_df = pl.read_parquet(a_path)
-
-            append_df = pl.concat([old_df, data_obj])
-        else:
-            append_df = data_obj
         # SORTING
-        append_df = append_df.sort(sort_on)
-        # Save the appended data to a new Parquet
-        append_df.write_parquet(a_path, **kwargs)
-        if append_df.estimated_size() > config.DEFAULT_PARTITION_SIZE:
+        if sort_on is not None:
+            data_obj = data_obj.sort(sort_on)
+        # Save the appended data to a new Parquet file next to earlier appends
+        p_path = utils.make_path(i_path, f"partition={i_part}")
+        p_path.mkdir(parents=True, exist_ok=True)
+        a_path = utils.make_path(p_path, self._part_file_name())
+        data_obj.write_parquet(a_path, **utils.parquet_write_options(kwargs))
+        a_size = a_path.stat().st_size
+        i_meta["_n_partitions"] = i_part
+        i_meta["_has_appended"] = True
+        if "_size_bytes" in i_meta:
+            i_meta["_size_bytes"] += a_size
+        # running byte count of the append partition, no walk of its files per append
+        if "_append_bytes" in i_meta:
+            i_meta["_append_bytes"] += a_size
+        else:
+            i_meta["_append_bytes"] = utils.dir_size(p_path, "*.parquet")
+        utils.write_metadata(i_path, i_meta)
+        self._invalidate("inventory", "_dataset")
+        if i_meta["_append_bytes"] > config.DEFAULT_PARTITION_SIZE:
             print(f"""Warning:{item} Appended data size is larger than default partition size. 
-            Consider loading the whole dataset and overwriting partitioning""")
+            Consider running compact({item}) or loading the whole dataset and overwriting partitioning""")
+
+    def compact(self, item, sort_on=None, **kwargs):
+        """
+        merges the files of each partition of an item into a single file,
+        run offline, readers of the item should be closed
+        :param item:
+        :param sort_on: list of columns to sort each merged partition on
+        :param kwargs:
+        :return:
+        """
+        i_path = self._item_path(item)
+        i_meta = utils.read_metadata(i_path)
+        # written by write / lazy_write and not appended to since, every partition is one file
+        if i_meta.get("_has_appended") is False:
+            return True
+        for p in utils.subdirs(i_path):
+            if not p.startswith("partition="):
+                continue
+            p_path = utils.make_path(i_path, p)
+            files = sorted(str(f) for f in p_path.glob("*.parquet"))
+            if len(files) < 2:
+                continue
+            df = pl.read_parquet(files, hive_partitioning=False)
+            if sort_on is not None:
+                df = df.sort(sort_on)
+            # write the merged file before removing the parts, a failure leaves the parts in place
+            c_path = utils.make_path(p_path, self._part_file_name())
+            df.write_parquet(c_path, **utils.parquet_write_options(kwargs))
+            for f in files:
+                os.remove(f)
+        if "_size_bytes" in i_meta:
+            i_meta["_size_bytes"] = utils.parquet_size(i_path)
+        if "_append_bytes" in i_meta:
+            a_path = utils.make_path(i_path, f"partition={i_meta['_n_partitions']}")
+            i_meta["_append_bytes"] = utils.dir_size(a_path, "*.parquet")
+        i_meta["_has_appended"] = False
+        utils.write_metadata(i_path, i_meta)
+        self._invalidate("inventory", "_dataset")
+        return True
 
     def create_snapshot(self, snapshot=None):
         if snapshot:
@@ -301,31 +541,32 @@ class Subject:
         src = utils.make_path(self.library, self.subject)
         dst = utils.make_path(src, "_snapshots", snapshot)
 
-        shutil.copytree(src, dst,
-                        ignore=shutil.ignore_patterns("_snapshots"))
+        # reflinks share the data blocks, so a snapshot costs metadata not bytes
+        shutil.copytree(src, dst, copy_function=utils.clone_file,
+                        ignore=shutil.ignore_patterns("_snapshots", ".deleting-*"))
 
-        self.snapshots = self.list_snapshots()
+        self._invalidate("snapshots")
         return True
 
     def list_snapshots(self):
         snapshots = utils.subdirs(utils.make_path(
             self.library, self.subject, "_snapshots"))
-        return set(snapshots)
+        return frozenset(snapshots)
 
     def delete_snapshot(self, snapshot):
         if snapshot not in self.snapshots:
             # raise ValueError("Snapshot `%s` doesn't exist" % snapshot)
             return True
 
-        shutil.rmtree(utils.make_path(self.library, self.subject,
-                                      "_snapshots", snapshot))
-        self.snapshots = self.list_snapshots()
+        utils.remove_tree(utils.make_path(self.library, self.subject,
+                                          "_snapshots", snapshot))
+        self._invalidate("snapshots")
         return True
 
     def delete_snapshots(self):
         snapshots_path = utils.make_path(
             self.library, self.subject, "_snapshots")
-        shutil.rmtree(snapshots_path)
+        utils.remove_tree(snapshots_path)
         os.makedirs(snapshots_path)
-        self.snapshots = self.list_snapshots()
+        self._invalidate("snapshots")
         return True
\ No newline at end of file
@@ -1,16 +1,55 @@
 import os
 from datetime import datetime
 import json
+import copy
+import logging
 import shutil
+import fnmatch
+import re
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque, OrderedDict
 import pandas as pd
 import numpy as np
 import polars as pl
 import duckdb
+import pyarrow as pa
 from pathlib import Path
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 
 from . import config
 
+# linux ioctl to share the data blocks of one file with another (reflink)
+FICLONE = 0x40049409
+
+# metadata file path -> ((mtime_ns, size), parsed metadata), least recently used first
+_METADATA_CACHE = OrderedDict()
+_METADATA_CACHE_SIZE = 4096
+_METADATA_LOCK = threading.Lock()
+
+# (config.DEFAULT_PATH, Path of it), rebuilt when the configured path changes
+_PATH_CACHE = None
+
+# skip the atime update on metadata reads where the platform has the flag
+_O_NOATIME = getattr(os, "O_NOATIME", 0)
+
+# hidden .deleting-* directories this process is removing, sweep_deleting leaves them alone
+_DELETING = set()
+_DELETING_LOCK = threading.Lock()
+
+logger = logging.getLogger(__name__)
+
 
 def read_csv(urlpath, *args, **kwargs):
     def rename_dask_index(df, name):
@@ -41,82 +80,453 @@ def read_csv(urlpath, *args, **kwargs):
     return df
 
 
-def datetime_to_int64(df):
+def datetime_to_int64(df, datetime_col=None):
     """ convert datetime index to epoch int
     allows for cross language/platform portability
+    polars frames (eager or lazy) get their datetime columns, or datetime_col, cast in the plan
     """
+    if isinstance(df, (pl.DataFrame, pl.LazyFrame)):
+        col = pl.col(datetime_col) if datetime_col is not None else pl.col(pl.Datetime)
+        return df.with_columns(col.dt.epoch("ns"))
+
+    if datetime_col is not None:
+        col = df[datetime_col]
+        if isinstance(col.dtype, pd.DatetimeTZDtype):
+            col = col.dt.tz_convert("UTC").dt.tz_localize(None)
+        if col.dtype != "datetime64[ns]":
+            col = col.astype("datetime64[ns]")
+        # datetime64[ns] is int64 nanoseconds underneath, reinterpret instead of casting
+        df[datetime_col] = col.to_numpy().view(np.int64)
+        return df
 
-    if isinstance(df.index, dd.Index) and (
-            isinstance(df.index, pd.DatetimeIndex) and
-            any(df.index.nanosecond) > 0):
-        df.index = df.index.astype(np.int64)  # / 1e9
+    if isinstance(df.index, pd.DatetimeIndex) and (df.index.nanosecond > 0).any():
+        # reinterpret the datetime64[ns] values, no copy
+        df.index = df.index.view(np.int64)  # / 1e9
 
     return df
 
 
+def to_polars(data_obj, include_index=False):
+    """ pandas to polars, arrow backed pandas hands its buffers over without a copy """
+    if not isinstance(data_obj, pd.DataFrame):
+        return data_obj
+    if include_index and _has_data_index(data_obj.index):
+        # index columns first, the same layout whichever conversion runs below
+        data_obj = data_obj.reset_index()
+    if all(isinstance(d, pd.ArrowDtype) for d in data_obj.dtypes):
+        try:
+            return pl.from_arrow(pa.Table.from_pandas(data_obj, preserve_index=False))
+        except (pa.ArrowException, TypeError, ValueError):
+            pass
+    return pl.from_pandas(data_obj, rechunk=False)
+
+
+def _has_data_index(index):
+    """ a named or non-range index, an unnamed RangeIndex is only row numbers """
+    return not isinstance(index, pd.RangeIndex) or any(name is not None for name in index.names)
+
+
 def subdirs(d):
     """ use this to construct paths for future storage support """
-    return [o.parts[-1] for o in Path(d).iterdir()
-            if o.is_dir() and o.parts[-1] != "_snapshots"]
+    # DirEntry caches the entry type from the directory read, no stat per entry
+    # hidden entries are directories still being removed by remove_tree
+    try:
+        with os.scandir(d) as it:
+            return sorted(e.name for e in it
+                          if e.is_dir(follow_symlinks=False) and e.name != "_snapshots"
+                          and not e.name.startswith("."))
+    except FileNotFoundError:
+        return []
+
+def list_parquet_files(root):
+    """
+    parquet files in the subdirectories of root (partition dirs), as strings in partition order
+    hidden directories are skipped, they are still being removed by remove_tree
+    """
+    files = []
+    with os.scandir(root) as it:
+        dirs = deque(e.path for e in it
+                     if e.is_dir(follow_symlinks=False) and not e.name.startswith("."))
+    while dirs:
+        with os.scandir(dirs.popleft()) as it:
+            for e in it:
+                if e.is_dir(follow_symlinks=False):
+                    if not e.name.startswith("."):
+                        dirs.append(e.path)
+                elif e.name.endswith(".parquet") and e.is_file(follow_symlinks=False):
+                    files.append(e.path)
+    start = len(os.path.join(str(root), ""))
+    return sorted(files, key=lambda f: _partition_sort_key(f[start:]))
+
+def _partition_sort_key(rel_path):
+    """
+    sort key of a path below an item, integer hive values compare as integers
+    so partition=10 comes after partition=2, other parts compare as strings
+    """
+    key = []
+    for part in rel_path.split(os.sep):
+        name, sep, value = part.partition("=")
+        if sep and value.isdigit():
+            key.append((name, int(value), part))
+        else:
+            key.append((part, -1, part))
+    return key
+
+def parquet_size(root):
+    """ total bytes of the parquet files readers see under root """
+    return sum(os.stat(f).st_size for f in list_parquet_files(root))
+
+def _scandir_recursive(path, pattern="*"):
+    """
+    DirEntry of every file under path whose name matches pattern,
+    symlinked files count as their target, symlinked directories are not descended (as rglob)
+    """
+    # translate the pattern once instead of looking it up per file
+    match = None if pattern == "*" else re.compile(fnmatch.translate(pattern)).match
+    stack = [str(path)]
+    while stack:
+        try:
+            it = os.scandir(stack.pop())
+        except FileNotFoundError:
+            continue
+        with it:
+            for e in it:
+                if e.is_dir(follow_symlinks=False):
+                    stack.append(e.path)
+                elif e.is_file() and (match is None or match(e.name)):
+                    yield e
+
+def _entry_size(entry):
+    # the file can be removed between the directory read and the stat
+    try:
+        return entry.stat().st_size
+    except FileNotFoundError:
+        return 0
+
+def dir_size(path, pattern="*"):
+    """ total bytes of the files under path matching pattern """
+    return sum(map(_entry_size, _scandir_recursive(path, pattern)))
 
 def get_lib_size(library, pattern="*"):
     """ use this to construct paths for future storage support """
     path = get_path(library)
-    return sum(f.stat().st_size for f in Path(path).rglob(pattern) if f.is_file())
+    if pattern == "*":
+        return _top_level_size(path) + sum(_subject_size(make_path(path, s)) for s in subdirs(path))
+    return dir_size(path, pattern)
 
 def get_subject_size(library, subject, pattern="*"):
     """ use this to construct paths for future storage support """
     path = make_path(library, subject)
-    return sum(f.stat().st_size for f in Path(path).rglob(pattern) if f.is_file())
+    if pattern == "*":
+        return _subject_size(path)
+    return dir_size(path, pattern)
 
 def get_item_size(library, subject, item, pattern="*"):
     """ use this to construct paths for future storage support """
     path = make_path(library, subject, item)
-    return sum(f.stat().st_size for f in Path(path).rglob(pattern) if f.is_file())
+    if pattern == "*":
+        return _item_size(path)
+    return dir_size(path, pattern)
+
+def _top_level_size(path):
+    # files directly in path (metadata, schema), one directory read
+    try:
+        with os.scandir(path) as it:
+            return sum(_entry_size(e) for e in it if e.is_file())
+    except FileNotFoundError:
+        return 0
+
+def _item_size(path):
+    """
+    bytes of an item, the parquet bytes recorded in its metadata plus the files directly in the
+    item directory, the partitions are only walked when no size is recorded
+    """
+    size = read_metadata(path).get("_size_bytes")
+    if size is None:
+        return dir_size(path)
+    return size + _top_level_size(path)
+
+def _subject_size(path):
+    """
+    bytes of a subject (or of one of its snapshots, laid out the same way),
+    items and snapshots from their recorded sizes, directories being removed are not counted
+    """
+    items = [make_path(path, item) for item in subdirs(path)]
+    size = _top_level_size(path)
+    if items:
+        with ThreadPoolExecutor(max_workers=min(32, len(items))) as executor:
+            size += sum(executor.map(_item_size, items))
+    snapshots = make_path(path, "_snapshots")
+    size += _top_level_size(snapshots)
+    size += sum(_subject_size(make_path(snapshots, s)) for s in subdirs(snapshots))
+    return size
+
+def recorded_data_size(path):
+    """
+    bytes of an item's parquet data, the _size_bytes recorded by subject.write / lazy_write / append,
+    data files only, no snapshots or metadata, counted from disk when nothing is recorded
+    """
+    size = read_metadata(path).get("_size_bytes")
+    if size is None:
+        size = parquet_size(path)
+    return size
 
 def path_exists(path):
     """ use this to construct paths for future storage support """
     return path.exists()
 
 
+def _open_noatime(path, flags):
+    """ opener for open(), O_NOATIME is refused on files the user does not own """
+    if _O_NOATIME:
+        try:
+            return os.open(path, flags | _O_NOATIME)
+        except PermissionError:
+            pass
+    return os.open(path, flags)
+
+
 def read_metadata(path):
     """ use this to construct paths for future storage support """
     dest = make_path(path, "quiver_metadata.json")
-    if path_exists(dest):
-        with dest.open() as f:
-            return json.load(f)
-    else:
+    try:
+        st = dest.stat()
+    except FileNotFoundError:
         return {}
-
-
-def write_metadata(path, metadata={}):
+    key = str(dest)
+    # size as well, coarse mtime filesystems can miss a rewrite within one tick
+    version = (st.st_mtime_ns, st.st_size)
+    cached = _METADATA_CACHE.get(key)
+    if cached is None or cached[0] != version:
+        with open(dest, "rb", opener=_open_noatime) as f:
+            raw = f.read()
+        data = orjson.loads(raw) if orjson is not None else json.loads(raw)
+        cached = (version, data)
+    with _METADATA_LOCK:
+        _METADATA_CACHE[key] = cached
+        _METADATA_CACHE.move_to_end(key)
+        if len(_METADATA_CACHE) > _METADATA_CACHE_SIZE:
+            _METADATA_CACHE.popitem(last=False)
+    # callers mutate the result (nested values too), never hand out the cached objects
+    return copy.deepcopy(cached[1])
+
+
+def read_metadata_batch(paths):
+    """ read_metadata for many paths, file reads overlap across threads """
+    if not paths:
+        return []
+    with ThreadPoolExecutor(max_workers=min(32, len(paths))) as executor:
+        return list(executor.map(read_metadata, paths))
+
+
+def write_atomic(path, raw, fsync=False):
+    """
+    writes bytes beside the target and swaps them in, readers never see a partial file
+    :param path:
+    :param raw: bytes
+    :param fsync: flush the bytes to disk before the swap, for durability across power loss
+    :return:
+    """
+    # a unique name per writer, concurrent writers can't clobber each other's file before the swap
+    tmp_file = path.with_name(f".{path.name}.{os.getpid()}.{uuid.uuid4().hex}.tmp")
+    try:
+        with tmp_file.open("wb") as f:
+            f.write(raw)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+    except BaseException:
+        tmp_file.unlink(missing_ok=True)
+        raise
+    os.replace(tmp_file, path)
+
+
+def write_metadata(path, metadata=None, fsync=False):
     """ use this to construct paths for future storage support """
-    now = datetime.now()
-    metadata["_updated"] = now.strftime("%Y-%m-%d %H:%I:%S.%f")
+    if metadata is None:
+        metadata = {}
+    metadata["_updated"] = datetime.now().isoformat(sep=" ", timespec="microseconds")
     meta_file = make_path(path, "quiver_metadata.json")
-    with meta_file.open("w") as f:
-        json.dump(metadata, f, ensure_ascii=False)
-
-def write_subject_schema(path, schema={}):
+    if orjson is not None:
+        # json writes non-str keys (ints, floats, bools, None) as strings, so does orjson with the flag
+        raw = orjson.dumps(metadata, option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS)
+    else:
+        try:
+            raw = json.dumps(metadata, ensure_ascii=False, sort_keys=True).encode("utf-8")
+        except TypeError:
+            # keys of mixed types can't be sorted
+            raw = json.dumps(metadata, ensure_ascii=False).encode("utf-8")
+    with _METADATA_LOCK:
+        _METADATA_CACHE.pop(str(meta_file), None)
+    write_atomic(meta_file, raw, fsync=fsync)
+
+def write_subject_schema(path, schema=None, fsync=False):
     """ use this to construct paths for future storage support """
+    if schema is None:
+        schema = {}
     schema_file = make_path(path, "quiver_schema.json")
-    with schema_file.open("w") as f:
-        json.dump(schema, f, ensure_ascii=False)
+    if orjson is not None:
+        raw = orjson.dumps(schema)
+    else:
+        raw = json.dumps(schema, ensure_ascii=False).encode("utf-8")
+    write_atomic(schema_file, raw, fsync=fsync)
+
+
+def parquet_write_options(kwargs, eager=True):
+    """
+    config.PARQUET_WRITE_OPTIONS overridden by the caller's kwargs,
+    eager writes also get a page index unless the caller picks the writer
+    :param kwargs: write_parquet / sink_parquet keyword arguments
+    :param eager: False for sink_parquet, which has no pyarrow writer
+    :return:
+    """
+    options = {**config.PARQUET_WRITE_OPTIONS, **kwargs}
+    if eager and config.PARQUET_PAGE_INDEX and "use_pyarrow" not in kwargs:
+        options["use_pyarrow"] = True
+        options["pyarrow_options"] = {"write_page_index": True, **options.get("pyarrow_options", {})}
+    return options
+
+
+def partition_expr(n_partitions):
+    """
+    partition number per row as a single fused expression,
+    the row count is taken inside the plan so lazy frames need no separate count pass
+    """
+    dtype = pl.UInt16 if n_partitions < 65536 else pl.UInt32
+    return ((pl.int_range(0, pl.len(), dtype=pl.UInt64) * n_partitions // pl.len())
+            .cast(dtype).alias("partition"))
+
+
+def clone_file(src, dst):
+    """ copy-on-write clone on filesystems that support it (btrfs, xfs), otherwise a regular copy """
+    if fcntl is not None:
+        try:
+            with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            shutil.copystat(src, dst)
+            return dst
+        except OSError:
+            pass
+    return shutil.copy2(src, dst)
+
+
+def _rmtree(path):
+    # another process sweeping the same .deleting-* tree may unlink entries first,
+    # those are not errors, carry on until the tree is gone
+    while True:
+        try:
+            shutil.rmtree(path)
+            return
+        except FileNotFoundError:
+            if not os.path.lexists(path):
+                return
+
+
+class _Removal(threading.Thread):
+    """ rmtree in the background, failures are logged and raised again by wait() """
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self.error = None
+
+    def run(self):
+        try:
+            _rmtree(self.path)
+        except OSError as e:
+            # the directory is left for sweep_deleting
+            self.error = e
+            logger.warning("could not remove %s: %s", self.path, e)
+        finally:
+            with _DELETING_LOCK:
+                _DELETING.discard(str(self.path))
+
+    def wait(self):
+        self.join()
+        if self.error is not None:
+            raise self.error
+
+
+def _start_removal(hidden):
+    thread = _Removal(hidden)
+    thread.start()
+    return thread
+
+
+def remove_tree(path):
+    """
+    renames the directory out of sight and removes it in a background thread,
+    the call returns once the rename is done
+    where the rename fails (no write permission on the parent, a mount point)
+    the directory is removed in place and errors are raised
+    :param path:
+    :return: the thread doing the removal, its wait() raises what could not be removed,
+        None when it was removed in place
+    """
+    path = Path(path)
+    hidden = path.with_name(f".deleting-{path.name}-{uuid.uuid4().hex}")
+    try:
+        os.rename(path, hidden)
+    except OSError:
+        shutil.rmtree(path)
+        return None
+    with _DELETING_LOCK:
+        _DELETING.add(str(hidden))
+    thread = _start_removal(hidden)
+    # directories a failed or interrupted removal left behind
+    sweep_deleting(path.parent)
+    return thread
+
+
+def sweep_deleting(parent):
+    """
+    removes the .deleting-* directories under parent that no removal is working on,
+    left behind by a failed removal or a process that exited mid-delete
+    :param parent:
+    :return: the threads doing the removal
+    """
+    try:
+        with os.scandir(parent) as it:
+            stale = [e.path for e in it
+                     if e.name.startswith(".deleting-") and e.is_dir(follow_symlinks=False)]
+    except FileNotFoundError:
+        return []
+    with _DELETING_LOCK:
+        stale = [p for p in stale if p not in _DELETING]
+        _DELETING.update(stale)
+    return [_start_removal(p) for p in stale]
+
+
+def sql_identifier(name):
+    """ double quoted duckdb identifier """
+    return '"' + str(name).replace('"', '""') + '"'
+
+
+def sql_file_list(files):
+    """ duckdb list literal of file paths, lets read_parquet skip globbing """
+    quoted = ("'" + str(f).replace("'", "''") + "'" for f in files)
+    return "[" + ", ".join(quoted) + "]"
 
 
 def make_path(*args):
     """ use this to construct paths for future storage support """
     # return Path(os.path.join(*args))
-    return Path(*args)
+    return Path(*(a for a in args if a is not None))
 
 
 def get_path(*args):
     """ use this to construct paths for future storage support """
     # return Path(os.path.join(config.DEFAULT_PATH, *args))
-    return Path(config.DEFAULT_PATH, *args)
+    global _PATH_CACHE
+    root = config.DEFAULT_PATH
+    if _PATH_CACHE is None or _PATH_CACHE[0] != root:
+        _PATH_CACHE = (root, Path(root))
+    base = _PATH_CACHE[1]
+    return base.joinpath(*args) if args else base
 
 
 def set_path(path):
+    global _PATH_CACHE
     if path is None:
         path = get_path()
 
@@ -127,6 +537,7 @@ def set_path(path):
                 "PyStore currently only works with local file system")
 
     config.DEFAULT_PATH = path
+    _PATH_CACHE = None
     path = get_path()
 
     # if path does not exist - create it
@@ -137,28 +548,65 @@ def set_path(path):
 
 
 def list_libraries():
-    if not path_exists(get_path()):
-        os.makedirs(get_path())
-    return subdirs(get_path())
+    root = get_path()
+    os.makedirs(root, exist_ok=True)
+    return subdirs(root)
+
+
+def confirm_prompt(message):
+    """ default confirmation policy, prompts unless auto confirm is on """
+    if config.AUTO_CONFIRM:
+        return True
+    return input(message).lower() == "y"
 
 
-def delete_library(library, confirm=True):
+def confirmed(confirm, message, prompt=None):
+    """
+    resolves a confirm argument, a callable is asked directly,
+    True goes through prompt (confirm_prompt by default) and False skips the question
+    :param confirm: bool or callable(message) -> bool
+    :param message:
+    :param prompt:
+    :return:
+    """
+    if callable(confirm):
+        return confirm(message)
     if confirm:
-        confirm = input(f"Delete store {library}? (y/n)")
-        if confirm.lower() != "y":
-            print("Deletion aborted")
-            return False
-    shutil.rmtree(get_path(library))
+        return (prompt or confirm_prompt)(message)
     return True
 
 
-def delete_libraries(confirm=True):
-    if confirm:
-        confirm = input(f"This will delete all libraries and data do you want to continue? (y/n)")
-        if confirm.lower() != "y":
-            print("Deletion aborted")
-            return False
-    shutil.rmtree(get_path())
+def set_auto_confirm(auto_confirm=True):
+    config.AUTO_CONFIRM = auto_confirm
+    return config.AUTO_CONFIRM
+
+
+def delete_library(library, confirm=True, wait=False):
+    if not confirmed(confirm, f"Delete store {library}? (y/n)"):
+        print("Deletion aborted")
+        return False
+    # the name is free once remove_tree returns, wait blocks until the files are gone
+    thread = remove_tree(get_path(library))
+    if wait and thread is not None:
+        thread.wait()
+    return True
+
+
+def delete_libraries(confirm=True, wait=False):
+    if not confirmed(confirm, f"This will delete all libraries and data do you want to continue? (y/n)"):
+        print("Deletion aborted")
+        return False
+    # one thread per library, the unlinks of different libraries overlap,
+    # the root itself stays, it may be a mount point or in a directory we can't write to
+    root = get_path()
+    threads = [remove_tree(make_path(root, library)) for library in subdirs(root)]
+    if wait:
+        for thread in threads:
+            if thread is not None:
+                thread.join()
+        for thread in threads:
+            if thread is not None:
+                thread.wait()
     return True
 
 def set_partition_size(size=None):
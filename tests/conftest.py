@@ -0,0 +1,16 @@
+import pytest
+
+import quiver as qs
+
+
+@pytest.fixture
+def library(tmp_path):
+    qs.set_path(str(tmp_path))
+    lib = qs.Library("lib", confirm=lambda message: True)
+    yield lib
+    lib.stop_db()
+
+
+@pytest.fixture
+def subject(library):
+    return library.subject("sub")
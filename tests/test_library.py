@@ -0,0 +1,19 @@
+import polars as pl
+
+import quiver as qs
+
+
+def test_cached_subject_sees_items_written_and_deleted_elsewhere(library):
+    df = pl.DataFrame({"x": [1, 2]})
+    library.subject("sub").write("A", df, metadata={"k": "v"})
+    assert library.subject("sub").items == ["A"]
+
+    other = qs.Library("lib", confirm=lambda message: True)
+    other.subject("sub").write("B", df, metadata={"k": "v"})
+    assert library.subject("sub").items == ["A", "B"]
+    assert library.subject("sub").list_items(k="v") == ["A", "B"]
+
+    other.subject("sub").delete_item("A", confirm=False)
+    assert library.subject("sub").list_items() == ["B"]
+    assert library.subject("sub").list_items(k="v") == ["B"]
+    other.stop_db()
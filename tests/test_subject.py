@@ -0,0 +1,87 @@
+import polars as pl
+
+from quiver import utils
+
+
+def test_lazy_write_round_trip_keeps_row_order(subject):
+    df = pl.DataFrame({"x": list(range(20_000)), "y": [float(i) for i in range(20_000)]})
+    subject.write("item", df)
+    size = utils.recorded_data_size(subject._item_path("item"))
+
+    subject.lazy_write("item", df.lazy(), partition_size=max(1, size // 15), overwrite=True)
+
+    i_path = subject._item_path("item")
+    assert len([p for p in utils.subdirs(i_path) if p.startswith("partition=")]) >= 11
+    result = subject.item("item").to_polars()
+    assert result.columns == ["x", "y"]
+    assert result.equals(df)
+
+
+def test_append_keeps_row_order(subject):
+    subject.write("item", pl.DataFrame({"x": [0, 1]}))
+    for start in range(2, 26, 2):
+        subject.append("item", pl.DataFrame({"x": [start, start + 1]}))
+
+    assert subject.item("item").to_polars()["x"].to_list() == list(range(26))
+    metadata = utils.read_metadata(subject._item_path("item"))
+    a_path = subject._item_path("item") / f"partition={metadata['_n_partitions']}"
+    assert metadata["_append_bytes"] == utils.dir_size(a_path, "*.parquet")
+
+
+def test_list_items_matches_none_and_mixed_types(subject):
+    df = pl.DataFrame({"x": [1]})
+    subject.write("int", df, metadata={"kind": 1})
+    subject.write("str", df, metadata={"kind": "1"})
+    subject.write("none", df, metadata={"kind": None})
+    subject.write("missing", df, metadata={})
+
+    assert subject.list_items(kind=1) == ["int"]
+    assert subject.list_items(kind="1") == ["str"]
+    assert subject.list_items(kind=None) == ["missing", "none"]
+
+
+def test_list_items_sees_items_written_elsewhere(subject, library):
+    from quiver.subject import Subject
+
+    df = pl.DataFrame({"x": [1]})
+    subject.write("A", df, metadata={"k": "v"})
+    assert subject.list_items(k="v") == ["A"]
+
+    Subject("sub", library.library).write("B", df, metadata={"k": "v"})
+    assert subject.list_items(k="v") == ["A", "B"]
+
+
+def test_recorded_sizes_match_the_filesystem(subject, library):
+    subject.write("A", pl.DataFrame({"x": list(range(1000))}), metadata={"k": "v"})
+    subject.append("A", pl.DataFrame({"x": [1000]}))
+    subject.write("B", pl.DataFrame({"x": [1.5, 2.5]}))
+    subject.create_snapshot("snap")
+
+    assert utils.get_item_size(library.library, "sub", "A") == utils.dir_size(subject._item_path("A"))
+    assert utils.get_subject_size(library.library, "sub") == utils.dir_size(subject.subject_path)
+    assert utils.get_lib_size("lib") == utils.dir_size(library.library)
+
+
+def test_index_last_same_from_statistics_and_scan(subject):
+    from datetime import datetime
+
+    tstamp = pl.datetime_range(datetime(2024, 1, 1), datetime(2024, 1, 2), "1h", time_unit="ns", eager=True)
+    for time_unit in ("ns", "us"):
+        item = f"item_{time_unit}"
+        subject.write(item, pl.DataFrame({"tstamp": tstamp.dt.cast_time_unit(time_unit),
+                                          "x": range(len(tstamp))}))
+
+        from_statistics = subject.index(item, "tstamp", last=True)
+        # a where clause skips the footer statistics and scans the column
+        from_scan = subject.index(item, "tstamp", last=True, where=pl.col("x") >= 0)
+
+        assert from_statistics == from_scan == datetime(2024, 1, 2)
+        assert type(from_statistics) is type(from_scan)
+
+
+def test_save_subject_metadata_leaves_library_metadata(subject, library):
+    library.save_library_metadata({"description": "library"})
+    subject.save_subject_metadata({"description": "subject"})
+
+    assert utils.read_metadata(library.library)["description"] == "library"
+    assert utils.read_metadata(subject.subject_path)["description"] == "subject"
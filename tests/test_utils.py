@@ -0,0 +1,47 @@
+import polars as pl
+
+from quiver import utils
+
+
+def test_list_parquet_files_orders_partitions_numerically(tmp_path):
+    for partition in range(12):
+        p_path = tmp_path / f"partition={partition}"
+        p_path.mkdir()
+        pl.DataFrame({"x": [partition]}).write_parquet(p_path / "data.parquet")
+
+    files = utils.list_parquet_files(tmp_path)
+
+    assert [f.split("partition=")[1].split("/")[0] for f in files] == [str(p) for p in range(12)]
+
+
+def test_item_reads_partitions_in_order(subject):
+    i_path = subject.subject_path / "many"
+    for partition in range(12):
+        p_path = i_path / f"partition={partition}"
+        p_path.mkdir(parents=True)
+        pl.DataFrame({"x": [2 * partition, 2 * partition + 1]}).write_parquet(p_path / "data.parquet")
+
+    item = subject.item("many")
+
+    assert item.to_polars()["x"].to_list() == list(range(24))
+    assert item.head(2)["x"].tolist() == [0, 1]
+    assert item.tail(2)["x"].tolist() == [22, 23]
+    assert item.query_data()["x"].to_list() == list(range(24))
+
+
+def test_to_polars_arrow_and_numpy_paths_match():
+    import pandas as pd
+
+    index = pd.DatetimeIndex(["2024-01-01", "2024-01-02", "2024-01-03"], name="ts")
+    numpy_df = pd.DataFrame({"x": [1, 2, 3]}, index=index)
+    arrow_df = numpy_df.astype({"x": "int64[pyarrow]"})
+
+    for include_index in (False, True):
+        assert utils.to_polars(arrow_df, include_index).equals(utils.to_polars(numpy_df, include_index))
+    assert utils.to_polars(arrow_df, include_index=True).columns == ["ts", "x"]
+
+    # an unnamed RangeIndex is row numbers, neither path turns it into a column
+    numpy_df = numpy_df.reset_index(drop=True)
+    arrow_df = arrow_df.reset_index(drop=True)
+    assert utils.to_polars(arrow_df, include_index=True).columns == ["x"]
+    assert utils.to_polars(numpy_df, include_index=True).columns == ["x"]